@@ -150,7 +150,7 @@ def init_ai_analysis_ws(app):
         # 资金曲线数据
         if result.portfolio_history:
             prompt_parts.append("--- 资金曲线数据 ---\n")
-            prompt_parts.append(f"```json\n{result.portfolio_history}\n```\n") # 假设portfolio_history已经是JSON字符串
+            prompt_parts.append(f"```json\n{json.dumps(result.portfolio_history, ensure_ascii=False)}\n```\n") # portfolio_history 为 JSON 列，读出即为列表
             prompt_parts.append("（请结合资金曲线的形态，分析策略在不同市场阶段（如上涨、下跌、震荡市）的表现，并指出资金曲线的风险点，例如长期停滞或加速下跌的区间。）\n\n")
 
         # 详细交易日志
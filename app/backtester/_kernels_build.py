@@ -0,0 +1,22 @@
+"""
+AOT 预编译回测模拟内核。
+
+在构建/部署阶段运行一次:
+    python -m app.backtester._kernels_build
+
+会在 app/backtester/ 下生成 backtester_kernels 扩展模块（.so/.pyd），kernels.py 导入时优先使用该模块，
+Web 进程处理回测请求时不再有 Numba 的 JIT 编译和缓存加载开销。未生成该模块时自动退回 JIT 编译。
+"""
+import os
+
+from numba.pycc import CC
+
+from .kernels import _simulate_core, SIMULATE_CORE_SIGNATURE
+
+cc = CC('backtester_kernels')
+cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+cc.export('simulate_core', SIMULATE_CORE_SIGNATURE)(_simulate_core)
+
+
+if __name__ == '__main__':
+    cc.compile()
@@ -1,5 +1,11 @@
 import pandas as pd
+import numpy as np
 import json
+import orjson
+import connectorx as cx
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import logging
 
@@ -7,15 +13,30 @@ from app import db
 from app.models import Stock, DailyData, Strategy, BacktestResult, BacktestTrade
 from app.strategies import STRATEGY_MAP
 from .performance_analyzer import calculate_performance_metrics, calculate_trade_statistics
+from .kernels import simulate_core, TRADE_DTYPE, TRADE_BUY, TRADE_SELL
 
 logger = logging.getLogger(__name__)
 
+# connectorx 支持直接读取的数据库后端，其余后端回退到 pd.read_sql
+CONNECTORX_BACKENDS = {'mysql', 'postgresql', 'sqlite', 'mssql', 'oracle'}
+
+# 信号在矩阵中的整数编码
+SIGNAL_CODES = {'buy': 1, 'sell': -1, 'hold': 0}
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_params(raw: str) -> dict:
+    """解析策略参数 JSON，按原始文本缓存，参数扫描时反复构造引擎无需重复解析。"""
+    return orjson.loads(raw)
+
+
 class BacktestEngine:
     """
     回测引擎，负责执行策略、模拟交易并记录结果。
     """
     def __init__(self, strategy_id: int, start_date: str, end_date: str, initial_capital: float, stock_codes: list,
-                 custom_parameters: dict = None, commission_rate: float = 0.0008, slippage: float = 0.0005):
+                 custom_parameters: dict = None, commission_rate: float = 0.0008, slippage: float = 0.0005,
+                 max_workers: int = None):
         """
         初始化回测引擎。
         :param strategy_id: 策略ID
@@ -26,21 +47,27 @@ class BacktestEngine:
         :param custom_parameters: 用户自定义的策略参数
         :param commission_rate: 交易佣金率
         :param slippage: 滑点比例
+        :param max_workers: 并行生成信号的最大线程数，默认为 CPU 核数，设为 1 则串行生成
         """
         self.strategy_model = Strategy.query.get_or_404(strategy_id)
         self.start_date = datetime.strptime(start_date, '%Y-%m-%d').date()
         self.end_date = datetime.strptime(end_date, '%Y-%m-%d').date()
         self.initial_capital = float(initial_capital)
         self.stock_codes = stock_codes
+        self._code_index = pd.Index(stock_codes)  # 股票代码 -> 矩阵列号（持仓数组、价格和信号矩阵的列顺序）
         self.commission_rate = commission_rate  # 例如 0.0008 ≈ 8bps
         self.slippage = slippage  # 0.05% 价差
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._stocks = None  # 缓存的 Stock 记录，首次获取数据时加载
+        self._stock_map = {}  # {stock_code: stock_id}
         
         # 优先使用传入的自定义参数，否则使用数据库中存储的默认参数
         if custom_parameters is not None:
             self.strategy_params = custom_parameters
             self.parameters_to_save = json.dumps(custom_parameters)
         else:
-            self.strategy_params = json.loads(self.strategy_model.parameters)
+            # 缓存的结果被多个引擎共享，复制一份避免互相修改
+            self.strategy_params = dict(_parse_params(self.strategy_model.parameters))
             self.parameters_to_save = self.strategy_model.parameters
         
         # 从STRATEGY_MAP中获取策略实现类
@@ -62,11 +89,14 @@ class BacktestEngine:
             logger.warning("在指定日期范围内未找到任何股票数据。")
             return None
 
+        # 交易日历只排序一次，信号矩阵和价格矩阵共用同一行顺序
+        trading_dates = np.sort(all_stocks_data['trade_date'].unique())
+
         # 2. 为每支股票生成交易信号
-        all_signals = self._generate_all_signals(all_stocks_data)
+        signals = self._generate_all_signals(all_stocks_data, trading_dates)
 
         # 3. 模拟交易过程
-        portfolio_history_df, trades = self._simulate_trading(all_stocks_data, all_signals)
+        portfolio_history_df, trades = self._simulate_trading(all_stocks_data, trading_dates, signals)
 
         # 4. 计算最终结果
         final_value = portfolio_history_df['total'].iloc[-1]
@@ -96,11 +126,19 @@ class BacktestEngine:
         
         return result_id
 
+    def _load_stocks(self) -> list:
+        """查询并缓存本次回测涉及的股票记录，供数据获取和结果保存共用。"""
+        if self._stocks is None:
+            self._stocks = Stock.query.filter(Stock.code.in_(self.stock_codes)).all()
+            self._stock_map = {s.code: s.id for s in self._stocks}
+        return self._stocks
+
     def _fetch_data(self) -> pd.DataFrame:
         """为所有选定股票在指定日期范围内获取历史数据。"""
         logger.info(f"正在为 {len(self.stock_codes)} 支股票获取从 {self.start_date} 到 {self.end_date} 的数据...")
         
-        stock_map = {s.code: s.id for s in Stock.query.filter(Stock.code.in_(self.stock_codes)).all()}
+        self._load_stocks()
+        stock_map = self._stock_map
         stock_ids = list(stock_map.values())
 
         if not stock_ids:
@@ -112,169 +150,187 @@ class BacktestEngine:
             DailyData.trade_date <= self.end_date
         ).order_by(DailyData.stock_id, DailyData.trade_date)
         
-        df = pd.read_sql(query.statement, db.engine)
+        df = self._read_daily_data(query, stock_ids)
         
-        # 将stock_id映射回stock_code以便于处理
-        reverse_stock_map = {id: code for code, id in stock_map.items()}
-        df['stock_code'] = df['stock_id'].map(reverse_stock_map)
+        # 将stock_id映射回stock_code以便于处理：先按类别编码 stock_id，再把编码换算为矩阵列号，
+        # 得到以 self.stock_codes 为类别的 Categorical，全程为向量化的整数运算
+        found_codes = list(stock_map)
+        id_codes = pd.Categorical(df['stock_id'], categories=[stock_map[code] for code in found_codes]).codes
+        column_of = self._code_index.get_indexer(found_codes)
+        df['stock_code'] = pd.Categorical.from_codes(column_of[id_codes], categories=self._code_index)
 
         logger.info(f"数据获取完成，共 {len(df)} 条记录。")
         return df
 
-    def _generate_all_signals(self, all_stocks_data: pd.DataFrame) -> dict:
-        """为回测范围内的每支股票生成一次信号。"""
+    def _read_daily_data(self, query, stock_ids: list) -> pd.DataFrame:
+        """
+        执行日线查询并加载为 DataFrame。
+        优先用 connectorx 按 stock_id 分区并行读取到列式缓冲区，不支持的后端或读取失败时回退到 pd.read_sql。
+        """
+        url = db.engine.url
+        if url.get_backend_name() in CONNECTORX_BACKENDS:
+            try:
+                # connectorx 不识别 SQLAlchemy 的驱动名和 charset 等连接参数
+                conn = url.set(drivername=url.get_backend_name(), query={}).render_as_string(hide_password=False)
+                sql = str(query.statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+                partition_kwargs = {}
+                if len(stock_ids) > 1:
+                    partition_kwargs = {'partition_on': 'stock_id', 'partition_num': min(8, len(stock_ids))}
+                df = cx.read_sql(conn, sql, return_type='pandas', **partition_kwargs)
+
+                # 分区结果之间不保证顺序；日期列统一为 datetime.date，与 pd.read_sql 的结果保持一致
+                df['trade_date'] = pd.to_datetime(df['trade_date']).dt.date
+                return df.sort_values(['stock_id', 'trade_date'], ignore_index=True)
+            except Exception as e:
+                logger.warning(f"connectorx 读取日线数据失败，回退到 pd.read_sql: {e}")
+
+        return pd.read_sql(query.statement, db.engine)
+
+    def _generate_all_signals(self, all_stocks_data: pd.DataFrame, trading_dates: np.ndarray) -> np.ndarray:
+        """
+        为回测范围内的每支股票生成一次信号，并编码为 (交易日 × 股票) 的 int8 矩阵。
+        :return: 信号矩阵，1 买入 / -1 卖出 / 0 持有，列顺序与 self.stock_codes 一致。
+        """
         logger.info("正在生成交易信号...")
-        signals = {}
-        for stock_code, group in all_stocks_data.groupby('stock_code'):
-            logger.debug(f"为 {stock_code} 生成信号...")
-            signals[stock_code] = self.strategy.generate_signals(group)
+
+        # 以 self.stock_codes 为类别转换为 Categorical，分组时直接按整数编码（即矩阵列号）进行，无需排序和字符串哈希
+        if not isinstance(all_stocks_data['stock_code'].dtype, pd.CategoricalDtype):
+            all_stocks_data['stock_code'] = pd.Categorical(all_stocks_data['stock_code'], categories=self._code_index)
+
+        # 每支股票的信号生成后立即编码为 int8 写入矩阵，不在内存中同时保留所有股票的字符串信号
+        signals = np.zeros((len(trading_dates), len(self.stock_codes)), dtype=np.int8)
+        date_index = pd.Index(trading_dates)
+        groups = list(all_stocks_data.groupby(all_stocks_data['stock_code'].cat.codes, sort=False))
+
+        # 各股票的信号计算相互独立，rolling/ewm 等数值计算会释放 GIL，可以用线程并行
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(groups)))) as executor:
+            for stock_idx, stock_signals in executor.map(self._generate_stock_signals, groups):
+                day_idx = date_index.get_indexer(stock_signals['trade_date'])
+                signals[day_idx, stock_idx] = stock_signals['signal'].map(SIGNAL_CODES).fillna(0).to_numpy(dtype=np.int8)
         logger.info("所有交易信号生成完毕。")
         return signals
 
-    def _simulate_trading(self, all_stocks_data: pd.DataFrame, all_signals: dict) -> (pd.DataFrame, list):
+    def _generate_stock_signals(self, group_item: tuple) -> (int, pd.DataFrame):
+        """
+        为单支股票生成信号，供线程池调用。
+        :param group_item: (矩阵列号, 该股票的行情数据)
+        """
+        stock_idx, group = group_item
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"为 {self.stock_codes[stock_idx]} 生成信号...")
+        return stock_idx, self.strategy.generate_signals(group)
+
+    def _matrix_indices(self, frame: pd.DataFrame, trading_dates: np.ndarray) -> (np.ndarray, np.ndarray):
+        """将长表中每行的交易日和股票代码映射为矩阵的行号和列号（哈希查找或类别编码，无需 pivot/reindex）。"""
+        day_idx = pd.Index(trading_dates).get_indexer(frame['trade_date'])
+        if isinstance(frame['stock_code'].dtype, pd.CategoricalDtype):
+            stock_idx = frame['stock_code'].cat.codes.to_numpy()
+        else:
+            stock_idx = self._code_index.get_indexer(frame['stock_code'])
+        return day_idx, stock_idx
+
+    def _build_price_matrix(self, all_stocks_data: pd.DataFrame, trading_dates: np.ndarray) -> np.ndarray:
+        """
+        将长表格式的行情转换为 (交易日 × 股票) 的收盘价矩阵，列顺序与 self.stock_codes 一致。
+        :return: 收盘价矩阵，缺失的收盘价为 NaN。
+        """
+        day_idx, stock_idx = self._matrix_indices(all_stocks_data, trading_dates)
+        prices = np.full((len(trading_dates), len(self.stock_codes)), np.nan, dtype=np.float64)
+        prices[day_idx, stock_idx] = all_stocks_data['close_price'].to_numpy(dtype=np.float64)
+        return prices
+
+    def _simulate_trading(self, all_stocks_data: pd.DataFrame, trading_dates: np.ndarray, signals: np.ndarray) -> (pd.DataFrame, list):
         """核心交易模拟逻辑。"""
         logger.info("开始模拟交易...")
-        
-        cash = self.initial_capital
-        positions = {code: 0 for code in self.stock_codes} # 持股数量 {stock_code: quantity}
-        portfolio_history = []
-        trades = []
 
-        # 按照交易日历进行每日迭代
-        for trade_date in sorted(all_stocks_data['trade_date'].unique()):
-            
-            # 在每日开始时，先处理卖出信号
-            for stock_code in self.stock_codes:
-                if positions[stock_code] > 0: # 只有持仓的才需要考虑卖
-                    stock_signals = all_signals.get(stock_code)
-                    if stock_signals is None: continue
-                    
-                    day_signal_row = stock_signals[stock_signals['trade_date'] == trade_date]
-                    if day_signal_row.empty: continue
-
-                    signal = day_signal_row.iloc[0]['signal']
-                    if signal == 'sell':
-                        current_price = day_signal_row.iloc[0]['close_price']
-
-                        # 应用滑点：卖出则以略低价格成交
-                        executed_price = current_price * (1 - self.slippage)
-                        quantity_to_sell = positions[stock_code]
-                        trade_amount = executed_price * quantity_to_sell
-                        commission = trade_amount * self.commission_rate
-                        cash += trade_amount - commission
-                        positions[stock_code] = 0
-
-                        trades.append({
-                            'stock_code': stock_code, 'date': trade_date, 'trade_type': 'sell',
-                            'price': executed_price, 'quantity': quantity_to_sell, 'amount': trade_amount,
-                            'commission': commission, 'cash_after': cash
-                        })
-                        logger.debug(f"[{trade_date}] 卖出 {stock_code}: {quantity_to_sell} 股 @ {current_price}, 现金: {cash:.2f}")
-
-            # 处理完卖出后，用剩余现金处理买入信号
-            # 简单平均分配资金给每个买入机会
-            buy_signals_today = []
-            for stock_code in self.stock_codes:
-                 if positions[stock_code] == 0: # 只有空仓的才考虑买
-                    stock_signals = all_signals.get(stock_code)
-                    if stock_signals is None: continue
-                    
-                    day_signal_row = stock_signals[stock_signals['trade_date'] == trade_date]
-                    if day_signal_row.empty: continue
-
-                    signal = day_signal_row.iloc[0]['signal']
-                    if signal == 'buy':
-                        buy_signals_today.append({'code': stock_code, 'row': day_signal_row.iloc[0]})
-            
-            if buy_signals_today and cash > 1: # 留1块钱防止全买完
-                capital_per_buy = cash / len(buy_signals_today)
-                for buy_op in buy_signals_today:
-                    stock_code = buy_op['code']
-                    current_price = buy_op['row']['close_price']
-
-                    # 应用滑点：买入则以略高价格成交
-                    executed_price = current_price * (1 + self.slippage)
-
-                    # 上海深圳市场以100股为最小交易单位，确保买入数量是100的整数倍
-                    raw_qty = int(capital_per_buy // executed_price)
-                    quantity = (raw_qty // 100) * 100
-                    if quantity >= 100:
-                        positions[stock_code] = quantity
-                        trade_amount = executed_price * quantity
-                        commission = trade_amount * self.commission_rate
-                        cash -= (trade_amount + commission)
-                        trades.append({
-                            'stock_code': stock_code, 'date': trade_date, 'trade_type': 'buy',
-                            'price': executed_price, 'quantity': quantity, 'amount': trade_amount,
-                            'commission': commission, 'cash_after': cash
-                        })
-                        logger.debug(f"[{trade_date}] 买入 {stock_code}: {quantity} 股 @ {current_price}, 现金: {cash:.2f}")
-
-            # 计算当日结束时的总资产
-            current_portfolio_value = cash
-            for stock_code in self.stock_codes:
-                if positions[stock_code] > 0:
-                    # 获取当日股价
-                    today_price = all_stocks_data[
-                        (all_stocks_data['trade_date'] == trade_date) & 
-                        (all_stocks_data['stock_code'] == stock_code)
-                    ]['close_price'].iloc[0]
-                    current_portfolio_value += positions[stock_code] * today_price
-            
-            portfolio_history.append({'date': trade_date, 'total': current_portfolio_value})
+        prices = self._build_price_matrix(all_stocks_data, trading_dates)
+        n_days, n_stocks = prices.shape
 
-        logger.info("交易模拟结束。")
-        # ===== 强制平仓：在回测结束时将所有未平仓头寸按最后一个交易日收盘价全部卖出 =====
-        if positions and any(qty > 0 for qty in positions.values()):
-            last_trade_date = sorted(all_stocks_data['trade_date'].unique())[-1]
+        positions = np.zeros(n_stocks, dtype=np.int64)  # 持股数量，与 self.stock_codes 对齐
+        portfolio_values = np.empty(n_days, dtype=np.float64)
+        # 每笔交易至少消耗一个非持有信号，期末强制平仓每支股票至多一笔，两者之和即交易记录条数的上限
+        trade_log = np.empty(np.count_nonzero(signals) + n_stocks, dtype=TRADE_DTYPE)
 
-            for stock_code, qty in positions.items():
-                if qty <= 0:
-                    continue
+        # 以行压缩格式索引非持有信号：第 i 日有信号的列号为 signal_stocks[day_ptr[i]:day_ptr[i + 1]]
+        signal_stocks = np.flatnonzero(signals) % n_stocks
+        day_ptr = np.zeros(n_days + 1, dtype=np.int64)
+        np.cumsum(np.count_nonzero(signals, axis=1), out=day_ptr[1:])
 
-                # 获取最后一个交易日的收盘价
-                last_price_series = all_stocks_data[
-                    (all_stocks_data['trade_date'] == last_trade_date) &
-                    (all_stocks_data['stock_code'] == stock_code)
-                ]['close_price']
+        n_trades, cash = simulate_core(
+            prices, signals, day_ptr, signal_stocks, self.initial_capital, self.commission_rate, self.slippage,
+            positions, portfolio_values, trade_log
+        )
 
-                if last_price_series.empty:
-                    logger.warning(f"无法获取 {stock_code} 在 {last_trade_date} 的收盘价，跳过强制平仓。")
-                    continue
+        logger.info("交易模拟结束。")
+        portfolio_history = pd.DataFrame({'date': trading_dates, 'total': portfolio_values})
 
-                last_price = last_price_series.iloc[0]
+        # ===== 强制平仓：在回测结束时将所有未平仓头寸按最后一个交易日收盘价全部卖出 =====
+        if positions.any():
+            last_day = n_days - 1
+
+            for j in np.flatnonzero(positions > 0):
+                qty = positions[j]
+
+                # 获取最后一个交易日的收盘价；最后一日停牌时与逐日估值一致，沿用最近收盘价
+                last_price = prices[last_day, j]
+                if np.isnan(last_price):
+                    priced_days = np.flatnonzero(~np.isnan(prices[:, j]))
+                    last_price = prices[priced_days[-1], j]
+                    logger.warning(f"{self.stock_codes[j]} 在 {trading_dates[last_day]} 无收盘价，"
+                                   f"按 {trading_dates[priced_days[-1]]} 的收盘价 {last_price} 强制平仓。")
 
                 executed_price = last_price * (1 - self.slippage)
                 trade_amount = qty * executed_price
                 commission = trade_amount * self.commission_rate
                 cash += trade_amount - commission
 
-                trades.append({
-                    'stock_code': stock_code,
-                    'date': last_trade_date,
-                    'trade_type': 'sell',
-                    'price': executed_price,
-                    'quantity': qty,
-                    'amount': trade_amount,
-                    'commission': commission,
-                    'cash_after': cash
-                })
+                trade_log[n_trades] = (last_day, j, TRADE_SELL, executed_price, qty, trade_amount, commission, cash)
+                n_trades += 1
 
-                positions[stock_code] = 0  # 头寸已清空
+                positions[j] = 0  # 头寸已清空
 
             # 更新投资组合最终市值记录（覆盖最后一条记录）
-            if portfolio_history and portfolio_history[-1]['date'] == last_trade_date:
-                portfolio_history[-1]['total'] = cash
-            else:
-                portfolio_history.append({'date': last_trade_date, 'total': cash})
+            portfolio_history.loc[portfolio_history.index[-1], 'total'] = cash
+
+        # 交易记录在模拟全程保持为结构化数组，仅在此处转换为字典列表供统计和入库使用
+        trades = self._trade_records(trade_log[:n_trades], trading_dates)
+        return portfolio_history, trades
 
-        return pd.DataFrame(portfolio_history), trades
+    def _trade_records(self, trade_log: np.ndarray, trading_dates: np.ndarray) -> list:
+        """将模拟内核输出的交易记录数组转换为字典列表。"""
+        # f-string 在调用 logger.debug 前就会求值，先判断一次日志级别，避免逐笔交易无谓地格式化字符串
+        debug_enabled = logger.isEnabledFor(logging.DEBUG)
+        trades = []
+        for trade in trade_log:
+            stock_code = self.stock_codes[trade['stock']]
+            trade_date = trading_dates[trade['day']]
+            trade_type = 'buy' if trade['trade_type'] == TRADE_BUY else 'sell'
+            quantity = int(trade['quantity'])
+            trades.append({
+                'stock_code': stock_code, 'date': trade_date, 'trade_type': trade_type,
+                'price': float(trade['price']), 'quantity': quantity, 'amount': float(trade['amount']),
+                'commission': float(trade['commission']), 'cash_after': float(trade['cash_after'])
+            })
+            if debug_enabled:
+                action = '买入' if trade_type == 'buy' else '卖出'
+                logger.debug(f"[{trade_date}] {action} {stock_code}: {quantity} 股 @ {trade['price']:.3f}, 现金: {trade['cash_after']:.2f}")
+        return trades
+
+    def _portfolio_history_records(self, portfolio_history: pd.DataFrame) -> list:
+        """
+        将每日资产组合历史转换为原生列表，直接写入 JSON 列，由数据库驱动层的 orjson 序列化，
+        避免 DataFrame.to_json 的开销。
+        """
+        return [
+            {'date': trade_date.isoformat(), 'total': total}
+            for trade_date, total in zip(portfolio_history['date'].tolist(), portfolio_history['total'].tolist())
+        ]
 
     def _save_results(self, portfolio_history: pd.DataFrame, trades: list, final_value, total_return, metrics: dict) -> int:
         """将回测结果保存到数据库。"""
         
         # 收集选中股票的详细信息，方便后续回显
-        stocks_info = [s.to_dict() for s in Stock.query.filter(Stock.code.in_(self.stock_codes)).all()]
+        stocks_info = [s.to_dict() for s in self._load_stocks()]
 
         # 主结果记录
         result = BacktestResult(
@@ -294,7 +350,7 @@ class BacktestEngine:
             profit_factor=metrics.get('profit_factor'),
             expectancy=metrics.get('expectancy'),
             parameters_used=self.parameters_to_save,
-            portfolio_history=portfolio_history.to_json(orient='records', date_format='iso'),
+            portfolio_history=self._portfolio_history_records(portfolio_history),
             status='completed',
             completed_at=datetime.utcnow()
         )
@@ -305,20 +361,23 @@ class BacktestEngine:
         db.session.add(result)
         db.session.flush()
 
-        # 详细交易记录
-        for trade_data in trades:
-            trade = BacktestTrade(
-                backtest_result_id=result.id,
-                stock_code=trade_data['stock_code'],
-                trade_date=trade_data['date'],
-                trade_type=trade_data['trade_type'],
-                price=trade_data['price'],
-                quantity=trade_data['quantity'],
-                amount=trade_data['amount'],
-                commission=trade_data.get('commission', 0.0),
-                cash_after=trade_data['cash_after']
-            )
-            db.session.add(trade)
-            
+        # 详细交易记录：直接批量插入字典，跳过逐条构造 ORM 对象
+        trade_rows = [
+            {
+                'backtest_result_id': result.id,
+                'stock_code': trade_data['stock_code'],
+                'trade_date': trade_data['date'],
+                'trade_type': trade_data['trade_type'],
+                'price': trade_data['price'],
+                'quantity': trade_data['quantity'],
+                'amount': trade_data['amount'],
+                'commission': trade_data.get('commission', 0.0),
+                'cash_after': trade_data['cash_after']
+            }
+            for trade_data in trades
+        ]
+        if trade_rows:
+            db.session.bulk_insert_mappings(BacktestTrade, trade_rows)
+
         db.session.commit()
         return result.id 
\ No newline at end of file
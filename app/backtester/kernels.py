@@ -0,0 +1,134 @@
+import numpy as np
+from numba import njit, types, from_dtype
+
+# 交易方向在交易记录中的编码
+TRADE_BUY = 1
+TRADE_SELL = -1
+
+# 模拟内核输出的交易记录结构，day / stock 分别是交易日和股票在矩阵中的下标
+# 下标用 int32 足够；股数与 positions 一致保留 int64，避免大额资金买入时溢出；
+# 金额类字段保留 float64，避免现金余额等大额数值损失分位精度
+TRADE_DTYPE = np.dtype([
+    ('day', np.int32),
+    ('stock', np.int32),
+    ('trade_type', np.int8),
+    ('price', np.float64),
+    ('quantity', np.int64),
+    ('amount', np.float64),
+    ('commission', np.float64),
+    ('cash_after', np.float64),
+])
+
+# 预先声明的内核签名，JIT 和 AOT（见 _kernels_build.py）编译共用
+SIMULATE_CORE_SIGNATURE = types.Tuple((types.int64, types.float64))(
+    types.float64[:, ::1],          # prices: (交易日 × 股票) 收盘价，缺失为 NaN
+    types.int8[:, ::1],             # signals: 1 买入 / -1 卖出 / 0 持有
+    types.int64[::1],               # day_ptr: 第 i 日的非持有信号位于 signal_stocks[day_ptr[i]:day_ptr[i + 1]]
+    types.int64[::1],               # signal_stocks: 按日排列的非持有信号所在列号
+    types.float64,                  # initial_cash
+    types.float64,                  # commission_rate
+    types.float64,                  # slippage
+    types.int64[::1],               # positions: 输出，模拟结束时的持仓数量
+    types.float64[::1],             # portfolio_out: 输出，每日收盘后的总资产
+    from_dtype(TRADE_DTYPE)[::1],   # trade_log_out: 输出，交易记录缓冲区
+)
+
+
+def _simulate_core(prices, signals, day_ptr, signal_stocks, initial_cash, commission_rate, slippage,
+                  positions, portfolio_out, trade_log_out):
+    """
+    逐日模拟交易的编译内核，只操作预分配的数组。
+    每日先卖出持仓股票，再用剩余现金平均买入空仓股票，最后按最近收盘价计算总资产。
+    信号通常很稀疏，买卖只遍历当日有信号的股票，只有估值需要遍历全部股票。
+
+    :return: (交易记录条数, 期末现金)
+    """
+    n_days, n_stocks = prices.shape
+    last_prices = np.zeros(n_stocks, dtype=np.float64)  # 停牌日沿用最近收盘价估值
+    cash = initial_cash
+    n_trades = 0
+
+    for i in range(n_days):
+        first, last = day_ptr[i], day_ptr[i + 1]
+
+        # 先卖出有卖出信号的持仓股票，同时统计空仓股票的买入信号数量
+        n_buys = 0
+        for k in range(first, last):
+            j = signal_stocks[k]
+            price = prices[i, j]
+            if np.isnan(price):  # 当日无收盘价，无法成交，忽略该信号
+                continue
+
+            signal = signals[i, j]
+            if signal == -1 and positions[j] > 0:
+                # 应用滑点：卖出则以略低价格成交
+                executed_price = price * (1 - slippage)
+                quantity = positions[j]
+                trade_amount = executed_price * quantity
+                commission = trade_amount * commission_rate
+                cash += trade_amount - commission
+                positions[j] = 0
+
+                trade = trade_log_out[n_trades]
+                trade['day'] = i
+                trade['stock'] = j
+                trade['trade_type'] = TRADE_SELL
+                trade['price'] = executed_price
+                trade['quantity'] = quantity
+                trade['amount'] = trade_amount
+                trade['commission'] = commission
+                trade['cash_after'] = cash
+                n_trades += 1
+            elif signal == 1 and positions[j] == 0:
+                n_buys += 1
+
+        # 处理完卖出后，用剩余现金平均分配给每个买入机会
+        if n_buys > 0 and cash > 1:  # 留1块钱防止全买完
+            capital_per_buy = cash / n_buys
+            for k in range(first, last):
+                j = signal_stocks[k]
+                price = prices[i, j]
+                if signals[i, j] != 1 or positions[j] != 0 or np.isnan(price):
+                    continue
+
+                # 应用滑点：买入则以略高价格成交
+                executed_price = price * (1 + slippage)
+
+                # 上海深圳市场以100股为最小交易单位，确保买入数量是100的整数倍
+                raw_qty = np.int64(capital_per_buy // executed_price)
+                quantity = (raw_qty // 100) * 100
+                if quantity >= 100:
+                    positions[j] = quantity
+                    trade_amount = executed_price * quantity
+                    commission = trade_amount * commission_rate
+                    cash -= (trade_amount + commission)
+
+                    trade = trade_log_out[n_trades]
+                    trade['day'] = i
+                    trade['stock'] = j
+                    trade['trade_type'] = TRADE_BUY
+                    trade['price'] = executed_price
+                    trade['quantity'] = quantity
+                    trade['amount'] = trade_amount
+                    trade['commission'] = commission
+                    trade['cash_after'] = cash
+                    n_trades += 1
+
+        # 计算当日结束时的总资产，停牌股票沿用最近收盘价
+        holdings_value = 0.0
+        for j in range(n_stocks):
+            price = prices[i, j]
+            if not np.isnan(price):
+                last_prices[j] = price
+            holdings_value += positions[j] * last_prices[j]
+        portfolio_out[i] = cash + holdings_value
+
+    return n_trades, cash
+
+
+try:
+    # 优先使用 _kernels_build.py 预编译的扩展模块，避免首次调用时的 JIT 编译延迟
+    from .backtester_kernels import simulate_core
+except ImportError:
+    # 未预编译时退回 JIT：按声明的签名在导入时编译，cache=True 时直接从磁盘缓存加载
+    simulate_core = njit(SIMULATE_CORE_SIGNATURE, cache=True)(_simulate_core)
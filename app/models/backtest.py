@@ -41,7 +41,7 @@ class BacktestResult(db.Model):
     # 回测配置
     selected_stocks = db.Column(db.Text, comment='选中的股票列表JSON')
     parameters_used = db.Column(db.Text, comment='策略参数JSON')
-    portfolio_history = db.Column(db.Text, comment='每日资产组合历史JSON')
+    portfolio_history = db.Column(db.JSON().with_variant(JSONB(), 'postgresql'), comment='每日资产组合历史JSON')
     
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     completed_at = db.Column(db.DateTime, comment='完成时间')
@@ -91,7 +91,7 @@ class BacktestResult(db.Model):
             'error_message': self.error_message,
             'selected_stocks': self.get_selected_stocks(),
             'parameters_used': json.loads(self.parameters_used) if self.parameters_used else {},
-            'portfolio_history': json.loads(self.portfolio_history) if self.portfolio_history else [],
+            'portfolio_history': self.portfolio_history or [],
             'created_at': self.created_at.isoformat(),
             'completed_at': self.completed_at.isoformat() if self.completed_at else None,
             'ai_analysis_report': self.ai_analysis_report
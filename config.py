@@ -1,4 +1,5 @@
 import os
+import orjson
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -17,7 +18,10 @@ class Config:
         'pool_size': 10,
         'pool_timeout': 20,
         'pool_recycle': -1,
-        'pool_pre_ping': True
+        'pool_pre_ping': True,
+        # JSON 列使用 orjson 序列化/反序列化
+        'json_serializer': lambda obj: orjson.dumps(obj).decode(),
+        'json_deserializer': orjson.loads
     }
     
     # Flask配置
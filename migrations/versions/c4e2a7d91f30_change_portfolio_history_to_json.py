@@ -0,0 +1,38 @@
+"""change portfolio_history to JSON
+
+Revision ID: c4e2a7d91f30
+Revises: 1111217c5b24
+Create Date: 2026-10-15 10:12:45.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = 'c4e2a7d91f30'
+down_revision = '1111217c5b24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """将 backtest_results.portfolio_history 从 Text 改为 JSON（PostgreSQL 上为 JSONB），已有数据均为合法 JSON 文本"""
+    with op.batch_alter_table('backtest_results', schema=None) as batch_op:
+        batch_op.alter_column('portfolio_history',
+               existing_type=sa.Text(),
+               type_=sa.JSON().with_variant(postgresql.JSONB(), 'postgresql'),
+               existing_nullable=True,
+               existing_comment='每日资产组合历史JSON',
+               postgresql_using='portfolio_history::jsonb')
+
+
+def downgrade():
+    """回滚时改回 Text"""
+    with op.batch_alter_table('backtest_results', schema=None) as batch_op:
+        batch_op.alter_column('portfolio_history',
+               existing_type=sa.JSON().with_variant(postgresql.JSONB(), 'postgresql'),
+               type_=sa.Text(),
+               existing_nullable=True,
+               existing_comment='每日资产组合历史JSON',
+               postgresql_using='portfolio_history::text')